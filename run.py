@@ -15,6 +15,9 @@ def parse_args():
     parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Number of retries for failed transfers (default: 3)")
     parser.add_argument("--file-directory", type=str, default=DEFAULT_DIR, help="Directory to serve files from (default: /tmp/tftp)")
     parser.add_argument("--single-port", action='store_true', help="Use a single port for both read and write operations (default: False)")
+    parser.add_argument("--trace-log", type=str, default=None, help="File to append per-transfer phase timings to as JSON lines (default: disabled)")
+    parser.add_argument("--profile", action='store_true', help="Enable signal triggered profiling, SIGUSR1 toggles cProfile and SIGUSR2 toggles tracemalloc (default: False)")
+    parser.add_argument("--profile-directory", type=str, default=DEFAULT_PROFILE_DIR, help="Directory profiling captures are written to (default: /tmp/tftp_profiles)")
     return parser.parse_args()
 
 
@@ -27,7 +30,10 @@ def main():
         timeout=args.timeout,
         retries=args.retries,
         file_directory=args.file_directory,
-        single_port=args.single_port
+        single_port=args.single_port,
+        trace_log=args.trace_log,
+        profile=args.profile,
+        profile_directory=args.profile_directory
     )
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("TFTPServer")
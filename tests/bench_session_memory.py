@@ -0,0 +1,246 @@
+"""
+Benchmark of the memory used per session in single port and ephemeral port mode.
+
+Sessions are created through the server's own paths: TftpServerProtocol.datagram_received in single port mode and
+TftpServerProtocol.new_ephemeral_session plus connection_made in ephemeral port mode, with get_file replaced by a
+stub that holds every load until it is released. In both modes:
+- idle sessions have parsed their RRQ and are waiting for the file (the pending load task is counted),
+- active sessions have loaded the file, sent block 1 and received its ACK, so they are about to send block 2
+  (in ephemeral port mode the retransmit timer is armed).
+
+Sessions are first measured on a stub transport with tracemalloc, so only Python allocations are counted. The file
+buffer is shared by every session, like in the content store, and is excluded. Ephemeral port sessions are then
+measured again on real loopback sockets bound with create_datagram_endpoint, which adds the transport, the socket
+object and the selector registration of every session. For those the growth of the resident set size is reported too,
+measured in a fresh process without tracemalloc so neither its bookkeeping nor memory freed by an earlier run hides
+it. Memory the kernel allocates for the sockets (buffers, file descriptors) is not part of either number.
+
+Usage (from the project root): python -m tests.bench_session_memory [--sessions 1000 10000 100000] [--sockets 1000 10000]
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from tftp_server.config import TftpConfig
+from tftp_server.protocol import packets, protocol as protocol_module
+from tftp_server.protocol.protocol import ServerStates, TftpServerProtocol
+from tftp_server.tftp_server import TftpServer
+
+SHARED_FILE = bytes(64 * 1024 * 1024)  # content every active session references, allocated once like in the content store
+TIMEOUT = 60  # long enough for the retransmit timers and the single port expiry sweep not to fire while measuring
+
+class StubTransport:
+    """
+    Transport dropping every packet, shared by the sessions so it is not counted per session.
+    """
+    def sendto(self, data: bytes, addr) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+class FileLoads:
+    """
+    Stand-in for get_file, every load waits until release() is called and then returns SHARED_FILE.
+    """
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.pending = 0
+
+    async def get_file(self, file_type, file_path):
+        self.pending += 1
+        await self.released.wait()
+        self.pending -= 1
+        return SHARED_FILE
+
+    async def release(self) -> None:
+        self.released.set()
+        while self.pending:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)  # run the done callbacks, which send the first block
+
+def client_address(i: int) -> tuple:
+    # a fresh string per session like the address handed over by the socket
+    return f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 1024 + i % 60000
+
+def rrq_bytes(i: int) -> bytes:
+    return packets.RrqPacket(filename=f"firmware-{i % 100}.bin", mode="octet").get_bytes
+
+def ack(block: int) -> bytes:
+    return packets.AckPacket(block=block).get_bytes
+
+def is_active(session) -> bool:
+    return session.state == ServerStates.RRQ and session.state_config.offset > 0
+
+async def single_port_sessions(server: TftpServer, loads: FileLoads, count: int, active: bool) -> list:
+    protocol = TftpServerProtocol(server, logger=server.logger)
+    protocol.connection_made(StubTransport())
+    for i in range(count):
+        protocol.datagram_received(rrq_bytes(i), client_address(i))
+    await asyncio.sleep(0)  # start the load tasks
+    if active:
+        await loads.release()
+        for i in range(count):
+            protocol.datagram_received(ack(1), client_address(i))
+        assert all(is_active(client) for client in protocol.client_dict.values())
+    return [protocol]
+
+async def ephemeral_port_sessions(server: TftpServer, loads: FileLoads, count: int, active: bool) -> list:
+    protocol = TftpServerProtocol(server, logger=server.logger)
+    transport = StubTransport()
+    sessions = []
+    for i in range(count):
+        sessions.append(session := protocol.new_ephemeral_session(rrq_bytes(i), client_address(i)))
+        session.connection_made(transport)
+    await asyncio.sleep(0)
+    if active:
+        await loads.release()
+        for i, session in enumerate(sessions):
+            session.datagram_received(ack(1), client_address(i))
+        assert all(is_active(session) for session in sessions)
+    return sessions
+
+async def ephemeral_socket_sessions(server: TftpServer, loads: FileLoads, count: int, active: bool, client: tuple) -> list:
+    """
+    Ephemeral port sessions bound to loopback sockets, their packets are sent to client, which never reads them.
+    """
+    loop = asyncio.get_running_loop()
+    protocol = TftpServerProtocol(server, logger=server.logger)
+    sessions = []
+    for i in range(count):
+        addr = (".".join(client[0].split(".")), client[1])  # a fresh string per session, see client_address
+        _, session = await loop.create_datagram_endpoint(lambda: protocol.new_ephemeral_session(rrq_bytes(i), addr),
+                                                         local_addr=("127.0.0.1", 0))
+        sessions.append(session)
+    await asyncio.sleep(0)
+    if active:
+        await loads.release()
+        for session in sessions:
+            session.datagram_received(ack(1), (session.client_ip, session.client_port))
+        assert all(is_active(session) for session in sessions)
+    return sessions
+
+def resident_set_size() -> int | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+async def close(sessions: list) -> None:
+    for session in sessions:
+        if isinstance(session, TftpServerProtocol):
+            session.connection_lost(None)
+            continue
+        session._cancel_timeout()
+        if session.transport is not None and not isinstance(session.transport, StubTransport):
+            session.transport.close()
+    await asyncio.sleep(0)  # run connection_lost of the closed transports
+
+async def measure(build, count: int, active: bool) -> float:
+    """
+    Bytes allocated per session by build(loads, count, active), excluding the list holding the sessions.
+    """
+    loads = FileLoads()
+    with mock.patch.object(protocol_module, "get_file", loads.get_file):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = await build(loads, count, active)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        if not active:
+            await loads.release()  # let the pending loads finish before closing the sessions
+        await close(sessions)
+    return (used - sys.getsizeof(sessions)) / count
+
+def ephemeral_server(file_directory: str) -> TftpServer:
+    return TftpServer(TftpConfig(file_directory=file_directory, timeout=TIMEOUT, host="127.0.0.1"), logger=logging.getLogger("bench"))
+
+def loopback_client() -> socket.socket:
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    return client
+
+async def measure_socket_rss(count: int, active: bool) -> float | None:
+    """
+    Resident set size growth per ephemeral port session on a loopback socket, None where it cannot be read.
+    """
+    loads = FileLoads()
+    with tempfile.TemporaryDirectory() as file_directory, loopback_client() as client, \
+            mock.patch.object(protocol_module, "get_file", loads.get_file):
+        gc.collect()
+        before = resident_set_size()
+        sessions = await ephemeral_socket_sessions(ephemeral_server(file_directory), loads, count, active, client.getsockname())
+        gc.collect()
+        after = resident_set_size()
+        if not active:
+            await loads.release()
+        await close(sessions)
+    return (after - before) / count if before is not None else None
+
+def socket_rss(count: int, active: bool) -> float | None:
+    # entry point of the fresh process
+    return asyncio.run(measure_socket_rss(count, active))
+
+def socket_limit(needed: int) -> int:
+    """
+    Raise the open file limit towards needed, return the number of sockets that can be opened.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft - 100  # keep room for the descriptors already open
+
+def print_row(mode: str, active: bool, count: int, per_session: float, rss: float | None = None) -> None:
+    rss_column = "" if rss is None else f"{rss:>14.1f}"
+    print(f"{mode:<16} {'active' if active else 'idle':<7} {count:>9} {per_session:>14.1f} {rss_column}")
+
+async def run(session_counts: list, socket_counts: list) -> None:
+    with tempfile.TemporaryDirectory() as file_directory:
+        single_server = TftpServer(TftpConfig(file_directory=file_directory, timeout=TIMEOUT, single_port=True), logger=logging.getLogger("bench"))
+        server = ephemeral_server(file_directory)
+        print(f"{'mode':<16} {'state':<7} {'sessions':>9} {'bytes/session':>14} {'rss/session':>14}")
+        for mode, build in (("single", lambda *args: single_port_sessions(single_server, *args)),
+                            ("ephemeral", lambda *args: ephemeral_port_sessions(server, *args))):
+            for active in (False, True):
+                for count in session_counts:
+                    print_row(mode, active, count, await measure(build, count, active))
+
+        limit = socket_limit(max(socket_counts, default=0) + 100)
+        # one fresh process per resident set size measurement, the open file limit raised above is inherited
+        with loopback_client() as client, ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1,
+                                                              mp_context=multiprocessing.get_context("spawn")) as pool:
+            build = lambda *args: ephemeral_socket_sessions(server, *args, client.getsockname())
+            for active in (False, True):
+                for count in socket_counts:
+                    if count > limit:
+                        print(f"ephemeral socket: skipping {count} sessions, only {limit} sockets can be opened")
+                        continue
+                    per_session = await measure(build, count, active)
+                    rss = await asyncio.get_running_loop().run_in_executor(pool, socket_rss, count, active)
+                    print_row("ephemeral socket", active, count, per_session, rss)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the memory used per TFTP session.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1000, 10000, 100000], help="Session counts to measure on a stub transport (default: 1000 10000 100000)")
+    parser.add_argument("--sockets", type=int, nargs="*", default=[1000, 10000], help="Ephemeral port session counts to measure on loopback sockets (default: 1000 10000)")
+    args = parser.parse_args()
+    asyncio.run(run(args.sessions, args.sockets))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Checks of the content store deduplication, eviction and reload behaviour.
+
+Usage (from the project root): python -m tests.test_content_store
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+from tftp_server.protocol import files_handler
+from tftp_server.protocol.files_handler import ContentStore, STREAM_THRESHOLD
+
+class CountingStore(ContentStore):
+    """
+    ContentStore counting the files it reads from disk and the contents it hashes.
+    """
+    def __init__(self, max_contents: int = 128):
+        super().__init__(max_contents)
+        self.loads = 0
+        self.hashes = 0
+
+    async def _load(self, file_path, identity):
+        self.loads += 1
+        return await super()._load(file_path, identity)
+
+    async def _hash(self, content):
+        self.hashes += 1
+        return await ContentStore._hash(content)
+
+def make_files(directory: str) -> None:
+    image = os.urandom(1000)
+    for name, content in (("image", image), ("other", os.urandom(1000)), ("small", os.urandom(10))):
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(content)
+    shutil.copy(os.path.join(directory, "image"), os.path.join(directory, "image_copy"))
+    os.symlink(os.path.join(directory, "image"), os.path.join(directory, "image_link"))
+    with open(os.path.join(directory, "large"), "wb") as f:
+        f.truncate(STREAM_THRESHOLD)
+
+def run_in_directory(check):
+    with tempfile.TemporaryDirectory() as directory:
+        make_files(directory)
+        asyncio.run(check(lambda name: os.path.join(directory, name)))
+
+def test_links_and_copies_share_a_buffer():
+    async def check(path):
+        store = CountingStore()
+        image = await store.get(path("image"))
+        assert await store.get(path("image_link")) is image
+        assert store.hashes == 0, "links resolve to the same identity without hashing"
+        assert await store.get(path("image_copy")) is image
+        assert store.hashes == 2, "a copy is hashed once along with the stored content of the same size"
+        other = await store.get(path("other"))
+        assert other is not image and len(other) == len(image)
+        assert await store.get(path("image_copy")) is image and store.hashes == 3
+        assert store.snapshot() == {"identities": 3, "paths": 4, "buffers": 2, "bytes_stored": 2000, "bytes_deduplicated": 2000}
+    run_in_directory(check)
+
+def test_contents_of_a_unique_size_are_not_hashed():
+    async def check(path):
+        store = CountingStore()
+        await store.get(path("image"))
+        await store.get(path("small"))
+        large = await store.get(path("large"))
+        assert not isinstance(large, bytes), "large files are not read into memory"
+        assert len(large) == STREAM_THRESHOLD
+        assert store.hashes == 0
+        assert store.snapshot()["bytes_stored"] == 1010
+    run_in_directory(check)
+
+def test_concurrent_requests_load_once():
+    async def check(path):
+        store = CountingStore()
+        contents = await asyncio.gather(*(store.get(path(name)) for name in ["image", "image_link"] * 10))
+        assert store.loads == 1
+        assert all(content is contents[0] for content in contents)
+        assert not store._loading
+    run_in_directory(check)
+
+def test_modified_file_is_reloaded():
+    async def check(path):
+        store = CountingStore()
+        before = await store.get(path("image"))
+        with open(path("image"), "r+b") as f:
+            f.write(b"changed")
+        stat = os.stat(path("image"))
+        os.utime(path("image"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        after = await store.get(path("image"))
+        assert store.loads == 2
+        assert after.startswith(b"changed") and after[7:] == before[7:]
+        assert len(store._contents) == 1, "the stale version is dropped"
+        assert store.snapshot()["bytes_stored"] == 1000
+    run_in_directory(check)
+
+def test_eviction_prunes_aliases_and_digests():
+    async def check(path):
+        store = CountingStore(max_contents=2)
+        image = await store.get(path("image"))
+        await store.get(path("image_copy"))
+        assert len(store._digests) == 2
+        await store.get(path("small"))
+        await store.get(path("large"))
+        assert len(store._contents) == 2
+        assert not store._digests
+        assert set(store._paths) == {path("small"), path("large")}
+        assert await store.get(path("image_link")) is not image, "evicted contents are loaded again"
+        assert store.loads == 5
+    run_in_directory(check)
+
+def test_missing_file():
+    async def check(path):
+        store = ContentStore()
+        assert await store.get(path("missing")) is None
+        assert await files_handler.get_file(files_handler.FileType.on_disk, path("missing")) is None
+        assert store.snapshot()["paths"] == 0
+    run_in_directory(check)
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"[PASS] {name}")
@@ -8,19 +8,24 @@ SERVER_LOG="/tmp/tftp_server.log"
 
 TFTP_HOST="127.0.0.1"
 TFTP_PORT=69
+TFTP_EPHEMERAL_PORT=6969
 TFTP_DIR="/tmp/tftp"
 JUNK_DIR="/tmp/tftp_junk"
 LOG_DIR="/tmp/tftp_test_logs"
 SERVER_CMD="python $PROJECT_ROOT/run.py --file-directory $TFTP_DIR --port $TFTP_PORT --single-port"
+EPHEMERAL_SERVER_LOG="/tmp/tftp_ephemeral_server.log"
+EPHEMERAL_SERVER_CMD="python $PROJECT_ROOT/run.py --file-directory $TFTP_DIR --port $TFTP_EPHEMERAL_PORT"
 FILES=("small_file" "medium_file" "large_file")
 SIZES=("20M" "50M" "80M")
 
 cleanup_server() {
     echo "[*] Stopping TFTP server..."
-    if [[ -n "${SERVER_PID:-}" ]]; then
-        kill "$SERVER_PID" 2>/dev/null || true
-        wait "$SERVER_PID" 2>/dev/null || true
-    fi
+    for pid in "${SERVER_PID:-}" "${EPHEMERAL_SERVER_PID:-}"; do
+        if [[ -n "$pid" ]]; then
+            kill "$pid" 2>/dev/null || true
+            wait "$pid" 2>/dev/null || true
+        fi
+    done
 }
 
 on_success() {
@@ -31,18 +36,27 @@ on_success() {
 
 trap 'echo "[✗] Tests failed. Logs kept in $LOG_DIR and server log $SERVER_LOG"; cleanup_server' ERR INT
 
+echo "[*] Running content store and transfer checks..."
+(cd "$PROJECT_ROOT" && python -m tests.test_content_store && python -m tests.test_transfers)
+
 echo "[*] Setting up test directories..."
 mkdir -p "$TFTP_DIR" "$JUNK_DIR" "$LOG_DIR"
 
-echo "[*] Starting TFTP server..."
+echo "[*] Starting TFTP servers..."
 $SERVER_CMD > "$SERVER_LOG" 2>&1 &
 SERVER_PID=$!
+$EPHEMERAL_SERVER_CMD > "$EPHEMERAL_SERVER_LOG" 2>&1 &
+EPHEMERAL_SERVER_PID=$!
 sleep 2  # Give server time to start
 # Check if server started successfully
 if ! ps -p "$SERVER_PID" > /dev/null; then
     echo "[✗] Failed to start TFTP server. Check $SERVER_LOG for details."
     exit 1
 fi
+if ! ps -p "$EPHEMERAL_SERVER_PID" > /dev/null; then
+    echo "[✗] Failed to start ephemeral port TFTP server. Check $EPHEMERAL_SERVER_LOG for details."
+    exit 1
+fi
 
 echo "[*] Creating test files..."
 for i in "${!FILES[@]}"; do
@@ -64,6 +78,34 @@ EOF
     fi
 done
 
+echo "[*] Testing GETs of a symlink and a copy of small_file..."
+ln -s "$TFTP_DIR/small_file" "$TFTP_DIR/small_file_link"
+cp "$TFTP_DIR/small_file" "$TFTP_DIR/small_file_copy"
+for file in small_file_link small_file_copy; do
+    tftp "$TFTP_HOST" "$TFTP_PORT" <<EOF &> "$LOG_DIR/get_$file.log"
+get $file $JUNK_DIR/downloaded_$file
+quit
+EOF
+
+    if ! diff "$TFTP_DIR/small_file" "$JUNK_DIR/downloaded_$file" &> "$LOG_DIR/diff_$file.log"; then
+        echo "[FAIL] Mismatch in GET $file. See $LOG_DIR/diff_$file.log"
+        exit 1
+    else
+        echo "[PASS] GET $file matched original."
+    fi
+done
+
+# SIGHUP logs the content store report, the link and the copy must share the buffer of small_file
+kill -HUP "$SERVER_PID"
+sleep 1
+EXPECTED_DEDUPLICATED=$((2 * ${SIZES[0]//[!0-9]/} * 1024 * 1024))
+if ! grep -a "Content store:" "$SERVER_LOG" | tail -1 | grep -q "'bytes_deduplicated': $EXPECTED_DEDUPLICATED}"; then
+    echo "[FAIL] Expected $EXPECTED_DEDUPLICATED deduplicated bytes in the content store report. See $SERVER_LOG"
+    exit 1
+else
+    echo "[PASS] Symlink and copy of small_file share one buffer."
+fi
+
 echo "[*] Testing 10 concurrent GETs on medium_file..."
 
 concurrent_get() {
@@ -94,7 +136,7 @@ for i in {1..10}; do
 done
 
 for job in $(jobs -p); do
-    if [[ "$job" != "$SERVER_PID" ]]; then
+    if [[ "$job" != "$SERVER_PID" && "$job" != "$EPHEMERAL_SERVER_PID" ]]; then
         if ! wait "$job"; then
             ((FAIL_COUNT++))
         fi
@@ -108,6 +150,59 @@ if [[ "$FAIL_COUNT" -gt 0 ]]; then
     exit 1
 fi
 
+echo "[*] Testing negotiated block number rollover on large_file (more than 65535 blocks)..."
+
+rollover_get() {
+    # the tftp client cannot negotiate options, stream the file with a minimal client and compare digests
+    # usage: rollover_get <port> <file> <rollover> <none|oack|wrap>, oack and wrap do not acknowledge the OACK or
+    # block 65535 the first time, so the server has to resend it after its timeout (ephemeral port mode only)
+    python - "$TFTP_HOST" "$1" "$2" "$3" "$4" <<'EOF'
+import hashlib, socket, struct, sys
+host, port, filename, rollover, drop = sys.argv[1], int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), sys.argv[5]
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.settimeout(5)
+sock.sendto(struct.pack("!H", 1) + f"{filename}\0octet\0rollover\0{rollover}\0".encode(), (host, port))
+oack = struct.pack("!H", 6) + f"rollover\0{rollover}\0".encode()
+packet, addr = sock.recvfrom(65536)
+if packet != oack:
+    sys.exit(f"expected OACK for rollover {rollover}, got {packet!r}")
+if drop == "oack":
+    packet, addr = sock.recvfrom(65536)
+    if packet != oack:
+        sys.exit(f"expected the OACK to be resent, got {packet!r}")
+sock.sendto(struct.pack("!HH", 4, 0), addr)
+digest, expected_block, dropped = hashlib.sha256(), 1, False
+while True:
+    packet, addr = sock.recvfrom(65536)
+    opcode, block = struct.unpack("!HH", packet[:4])
+    if opcode != 3 or block != expected_block:
+        sys.exit(f"expected DATA block {expected_block}, got opcode {opcode} block {block}")
+    if drop == "wrap" and block == 65535 and not dropped:
+        dropped = True
+        continue
+    digest.update(packet[4:])
+    sock.sendto(struct.pack("!HH", 4, block), addr)
+    if len(packet) - 4 < 512:
+        break
+    expected_block = rollover if block == 65535 else block + 1
+print(digest.hexdigest())
+EOF
+}
+
+ORIGINAL_DIGEST="$(sha256sum "$TFTP_DIR/large_file" | cut -d' ' -f1)"
+ROLLOVER_CASES=("$TFTP_PORT 0 none" "$TFTP_PORT 1 none" "$TFTP_EPHEMERAL_PORT 0 wrap" "$TFTP_EPHEMERAL_PORT 1 oack" "$TFTP_EPHEMERAL_PORT 1 wrap")
+for case in "${ROLLOVER_CASES[@]}"; do
+    read -r port rollover drop <<< "$case"
+    log="$LOG_DIR/rollover_${port}_${rollover}_${drop}.log"
+    if [[ "$(rollover_get "$port" large_file "$rollover" "$drop" 2> "$log")" != "$ORIGINAL_DIGEST" ]]; then
+        echo "[FAIL] GET large_file on port $port with rollover $rollover (dropped ACK: $drop) mismatch. See $log"
+        cleanup_server
+        exit 1
+    else
+        echo "[PASS] GET large_file on port $port with rollover $rollover (dropped ACK: $drop) matched original."
+    fi
+done
+
 echo "[*] Sending invalid UDP garbage to $TFTP_HOST:$TFTP_PORT..."
 echo "NOT_TFTP_PACKET" | nc -u -w1 "$TFTP_HOST" "$TFTP_PORT" || true
 
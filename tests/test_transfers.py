@@ -0,0 +1,306 @@
+"""
+Checks of the offset based block addressing, the rollover negotiation, the streaming of large files and the end of transfers.
+
+Usage (from the project root): python -m tests.test_transfers
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import tracemalloc
+from tftp_server.config import TftpConfig
+from tftp_server.protocol import packets
+from tftp_server.protocol.files_handler import STREAM_THRESHOLD
+from tftp_server.protocol.protocol import (MAX_BLOCK_VALUE, ServerStates, TftpEphemeralPortProtocol,
+                                           TftpServerProtocol, negotiate_options, wire_block)
+from tftp_server.tftp_server import TftpServer
+
+BLOCK_SIZE = 512
+CLIENT = ("127.0.0.1", 50000)
+LOGGER = logging.getLogger("test_transfers")
+LOGGER.setLevel(logging.ERROR)  # the timeouts below are expected
+
+class RecordingTransport:
+    """
+    Transport keeping only the last packet sent, so recording a transfer does not hold the file in memory.
+    """
+    def __init__(self):
+        self.last_sent: bytes = None
+        self.closed = False
+
+    def sendto(self, data: bytes, addr) -> None:
+        self.last_sent = data
+
+    def close(self) -> None:
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return None
+
+def test_wire_block_wraps_after_65535():
+    for k in (0, 1, 65533, 65534):
+        assert wire_block(k * BLOCK_SIZE, BLOCK_SIZE, 0) == wire_block(k * BLOCK_SIZE, BLOCK_SIZE, 1) == k + 1
+    assert wire_block(65535 * BLOCK_SIZE, BLOCK_SIZE, 0) == 0
+    assert wire_block(65535 * BLOCK_SIZE, BLOCK_SIZE, 1) == 1
+    assert wire_block(65536 * BLOCK_SIZE, BLOCK_SIZE, 0) == 1
+    assert wire_block(65536 * BLOCK_SIZE, BLOCK_SIZE, 1) == 2
+    # second wrap: rollover 0 counts 0..65535 (65536 blocks), rollover 1 counts 1..65535 (65535 blocks)
+    assert wire_block((65535 + 65535) * BLOCK_SIZE, BLOCK_SIZE, 0) == 65535
+    assert wire_block((65535 + 65536) * BLOCK_SIZE, BLOCK_SIZE, 0) == 0
+    assert wire_block((65535 + 65534) * BLOCK_SIZE, BLOCK_SIZE, 1) == 65535
+    assert wire_block((65535 + 65535) * BLOCK_SIZE, BLOCK_SIZE, 1) == 1
+    # offsets past 4 GiB and inside a block map to the block holding them
+    for k in (2 ** 23 + 17, 2 ** 40 + 3):
+        assert wire_block(k * BLOCK_SIZE + BLOCK_SIZE - 1, BLOCK_SIZE, 0) == (k + 1) % (MAX_BLOCK_VALUE + 1)
+        assert wire_block(k * BLOCK_SIZE, BLOCK_SIZE, 1) == k % MAX_BLOCK_VALUE + 1
+
+def test_negotiate_options():
+    assert negotiate_options({}) == {}
+    assert negotiate_options({"rollover": "0"}) == {"rollover": "0"}
+    assert negotiate_options({"rollover": "1", "blksize": "1428"}) == {"rollover": "1"}
+    assert negotiate_options({"rollover": "2"}) == {}
+
+def test_rrq_options_are_parsed():
+    packet = packets.parse_packet(struct.pack("!H", 1) + b"image\0octet\0RollOver\0001\0")
+    assert (packet.filename, packet.mode, packet.options) == ("image", "octet", {"rollover": "1"})
+    assert packets.parse_packet(packet.get_bytes).options == {"rollover": "1"}
+    assert packets.OackPacket(options={"rollover": "1"}).get_bytes == struct.pack("!H", 6) + b"rollover\0001\0"
+
+def test_undecodable_requests():
+    # an undecodable option is not negotiated, an undecodable filename or mode rejects the request
+    assert packets.parse_packet(struct.pack("!H", 1) + b"image\0octet\0rollover\0\xff\0").options == {"rollover": "�"}
+    assert negotiate_options({"rollover": "�"}) == {}
+    assert packets.parse_packet(struct.pack("!H", 1) + b"image\xff\0octet\0") is None
+    assert packets.parse_packet(struct.pack("!H", 1) + b"image") is None
+    session = TftpEphemeralPortProtocol(file_block_size=BLOCK_SIZE, base_file_dir="/nonexistent", client_ip=CLIENT[0],
+                                        client_port=CLIENT[1], initial_data=struct.pack("!H", 1) + b"\xff\0octet\0",
+                                        timeout=1, retries=3, logger=LOGGER)
+    transport = RecordingTransport()
+    session.connection_made(transport)
+    assert transport.closed, "the socket of a rejected request is closed"
+
+def ack(block: int) -> bytes:
+    return packets.AckPacket(block=block).get_bytes
+
+async def start_session(directory: str, filename: str, options: dict) -> tuple:
+    session = TftpEphemeralPortProtocol(file_block_size=BLOCK_SIZE, base_file_dir=directory, client_ip=CLIENT[0],
+                                        client_port=CLIENT[1], initial_data=packets.RrqPacket(filename, "octet", options).get_bytes,
+                                        timeout=1, retries=3, logger=LOGGER)
+    transport = RecordingTransport()
+    session.connection_made(transport)
+    while transport.last_sent is None:
+        await asyncio.sleep(0.01)
+    return session, transport
+
+async def stream(session: TftpEphemeralPortProtocol, transport: RecordingTransport, rollover: int) -> tuple:
+    """
+    Acknowledge every block like a client would, letting the block before the wrap time out once.
+    :return: digest of the data received and the number of blocks received.
+    """
+    digest, blocks, expected_block, timed_out = hashlib.sha256(), 0, 1, False
+    while True:
+        opcode, block = struct.unpack("!HH", transport.last_sent[:4])
+        assert (opcode, block) == (packets.Opcode.DATA.value, expected_block), (opcode, block, expected_block)
+        if block == MAX_BLOCK_VALUE and not timed_out:
+            # the ACK is lost, the server must resend the same block from the same offset
+            timed_out, sent = True, transport.last_sent
+            session._handle_timeout()
+            assert transport.last_sent == sent
+        data = transport.last_sent[4:]
+        digest.update(data)
+        blocks += 1
+        session.datagram_received(ack(block), CLIENT)
+        if blocks % 1000 == 0:
+            # let the event loop run like it does between datagrams, it purges the cancelled retransmit timers
+            await asyncio.sleep(0)
+        if len(data) < BLOCK_SIZE:
+            return digest.hexdigest(), blocks
+        expected_block = rollover if block == MAX_BLOCK_VALUE else block + 1
+
+def test_large_file_is_streamed_without_holding_it_in_memory():
+    async def check(directory: str, expected_digest: str, size: int):
+        for rollover in (0, 1):
+            tracemalloc.start()
+            session, transport = await start_session(directory, "large", {"rollover": str(rollover)})
+            oack = packets.OackPacket(options={"rollover": str(rollover)}).get_bytes
+            assert transport.last_sent == oack
+            session._handle_timeout()  # the OACK is lost, it must be sent again
+            assert transport.last_sent == oack
+            session.datagram_received(ack(0), CLIENT)
+            digest, blocks = await stream(session, transport, rollover)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            session._cancel_timeout()
+            assert digest == expected_digest
+            assert blocks == size // BLOCK_SIZE + 1 > MAX_BLOCK_VALUE
+            assert session.trace.retransmits == 2
+            assert peak < size // 16, f"peak of {peak} bytes while streaming a {size} bytes file"
+
+    with tempfile.TemporaryDirectory() as directory:
+        size = max(STREAM_THRESHOLD, (MAX_BLOCK_VALUE + 1) * BLOCK_SIZE) + 100
+        data = os.urandom(size)
+        with open(os.path.join(directory, "large"), "wb") as f:
+            f.write(data)
+        expected_digest = hashlib.sha256(data).hexdigest()
+        del data
+        asyncio.run(check(directory, expected_digest, size))
+
+def test_file_truncated_while_streamed():
+    async def check(directory: str):
+        session, transport = await start_session(directory, "large", {})
+        session.datagram_received(ack(1), CLIENT)
+        # rewritten in place, like cp new.img served.img
+        os.truncate(os.path.join(directory, "large"), BLOCK_SIZE + 10)
+        session.datagram_received(ack(2), CLIENT)
+        assert struct.unpack("!H", transport.last_sent[2:4])[0] == 3
+        assert len(transport.last_sent) == 4, "the transfer ends with an empty block instead of crashing"
+        assert session.state == ServerStates.KILL
+        session._cancel_timeout()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "large"), "wb") as f:
+            f.truncate(STREAM_THRESHOLD)
+        asyncio.run(check(directory))
+
+def block_sent(transport: RecordingTransport) -> int:
+    opcode, block = struct.unpack("!HH", transport.last_sent[:4])
+    assert opcode == packets.Opcode.DATA.value, opcode
+    return block
+
+def write_small_file(directory: str) -> None:
+    # two blocks, the second one is the final block
+    with open(os.path.join(directory, "small"), "wb") as f:
+        f.write(os.urandom(BLOCK_SIZE + 10))
+
+def test_only_the_final_ack_completes_an_ephemeral_transfer():
+    async def check(directory: str):
+        session, transport = await start_session(directory, "small", {})
+        session.datagram_received(ack(1), CLIENT)
+        assert block_sent(transport) == 2 and session.state == ServerStates.KILL
+        # the final block is lost, the client acknowledges the previous block again
+        session.datagram_received(ack(1), CLIENT)
+        session.datagram_received(ack(2), ("127.0.0.1", CLIENT[1] + 1))
+        assert not transport.closed and session.trace.last_ack_at is None
+        session.datagram_received(ack(2), CLIENT)
+        assert transport.closed and session.trace.last_ack_at is not None
+        session._cancel_timeout()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_small_file(directory)
+        asyncio.run(check(directory))
+
+def test_lost_final_block_is_resent_until_retries_run_out():
+    async def check(directory: str):
+        for acknowledged in (True, False):
+            session, transport = await start_session(directory, "small", {})
+            session.datagram_received(ack(1), CLIENT)
+            final = transport.last_sent
+            assert block_sent(transport) == 2 and session.state == ServerStates.KILL
+            for _ in range(session.max_retries + 1):
+                transport.last_sent = None
+                session._handle_timeout()
+                assert transport.last_sent == final and not transport.closed
+            if acknowledged:
+                session.datagram_received(ack(2), CLIENT)
+                assert transport.closed and session.trace.last_ack_at is not None
+            else:
+                session._handle_timeout()
+                assert transport.closed and session.trace.last_ack_at is None
+            assert session.trace.retransmits == session.max_retries + 1
+            session._cancel_timeout()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_small_file(directory)
+        asyncio.run(check(directory))
+
+def test_only_the_final_ack_completes_a_single_port_transfer():
+    async def check(directory: str):
+        server = TftpServer(TftpConfig(file_directory=directory, max_block_size=BLOCK_SIZE, single_port=True), logger=LOGGER)
+        protocol = TftpServerProtocol(server, logger=LOGGER)
+        transport = RecordingTransport()
+        protocol.connection_made(transport)
+        protocol.datagram_received(packets.RrqPacket("small", "octet").get_bytes, CLIENT)
+        while transport.last_sent is None:
+            await asyncio.sleep(0.01)
+        protocol.datagram_received(ack(1), CLIENT)
+        assert block_sent(transport) == 2
+        transport.last_sent = None
+        # the final block is lost, the client acknowledges the previous block again and gets it resent
+        protocol.datagram_received(ack(1), CLIENT)
+        assert block_sent(transport) == 2
+        assert CLIENT in protocol.client_dict and server.stats.completed == 0
+        protocol.datagram_received(ack(2), CLIENT)
+        assert CLIENT not in protocol.client_dict
+        assert (server.stats.completed, server.stats.failed, server.stats.retransmits) == (1, 0, 1)
+        protocol.connection_lost(None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_small_file(directory)
+        asyncio.run(check(directory))
+
+def test_single_port_repeated_rrq_resends_the_first_response():
+    async def check(directory: str):
+        server = TftpServer(TftpConfig(file_directory=directory, max_block_size=BLOCK_SIZE, single_port=True), logger=LOGGER)
+        protocol = TftpServerProtocol(server, logger=LOGGER)
+        transport = RecordingTransport()
+        protocol.connection_made(transport)
+        rrq = packets.RrqPacket("small", "octet", {"rollover": "1"}).get_bytes
+        oack = packets.OackPacket(options={"rollover": "1"}).get_bytes
+        protocol.datagram_received(rrq, CLIENT)
+        protocol.datagram_received(rrq, CLIENT)  # sent again while the file is loading, the load answers it
+        while transport.last_sent is None:
+            await asyncio.sleep(0.01)
+        # the OACK is lost, the client sends its RRQ again
+        transport.last_sent = None
+        protocol.datagram_received(rrq, CLIENT)
+        assert transport.last_sent == oack
+        protocol.datagram_received(ack(0), CLIENT)
+        first = transport.last_sent
+        assert block_sent(transport) == 1
+        # block 1 is lost, the client keeps sending its RRQ since it already acknowledged the OACK
+        transport.last_sent = None
+        protocol.datagram_received(rrq, CLIENT)
+        assert transport.last_sent == first
+        protocol.datagram_received(ack(1), CLIENT)
+        assert block_sent(transport) == 2
+        # once block 1 is acknowledged an RRQ is no longer a retry of the request
+        transport.last_sent = None
+        protocol.datagram_received(rrq, CLIENT)
+        assert transport.last_sent is None
+        protocol.datagram_received(ack(2), CLIENT)
+        assert (server.stats.completed, server.stats.failed, server.stats.retransmits) == (1, 0, 2)
+        protocol.connection_lost(None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_small_file(directory)
+        asyncio.run(check(directory))
+
+def test_single_port_client_expired_while_loading():
+    async def check(directory: str):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        server = TftpServer(TftpConfig(file_directory=directory, max_block_size=BLOCK_SIZE, single_port=True), logger=LOGGER)
+        protocol = TftpServerProtocol(server, logger=LOGGER)
+        transport = RecordingTransport()
+        protocol.connection_made(transport)
+        protocol.datagram_received(packets.RrqPacket("small", "octet").get_bytes, CLIENT)
+        protocol.client_dict[CLIENT].last_seen -= protocol.client_ttl + 1
+        protocol._expire_clients()  # the sweep runs before the load finishes
+        assert CLIENT not in protocol.client_dict and server.stats.failed == 1
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+        assert not errors, errors
+        assert transport.last_sent is None, "nothing is sent to an expired client"
+        protocol.connection_lost(None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_small_file(directory)
+        asyncio.run(check(directory))
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"[PASS] {name}")
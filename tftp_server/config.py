@@ -7,6 +7,7 @@ DEFAULT_TIMEOUT = 1
 DEFAULT_RETRIES = 3
 DEFAULT_DIR = "/tmp/tftp"
 DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PROFILE_DIR = "/tmp/tftp_profiles"
 
 @dataclass
 class TftpConfig:
@@ -20,6 +21,9 @@ class TftpConfig:
     retries: int = DEFAULT_RETRIES
     file_directory: str = DEFAULT_DIR
     single_port: bool = False
+    trace_log: str | None = None  # JSON lines file every finished transfer trace is appended to
+    profile: bool = False  # install the SIGUSR1/SIGUSR2 profiling hooks
+    profile_directory: str = DEFAULT_PROFILE_DIR
 
     def __post_init__(self):
         if not isinstance(self.port, int) or not (0 <= self.port <= 65535):
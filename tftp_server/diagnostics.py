@@ -0,0 +1,208 @@
+import asyncio
+import bisect
+import cProfile
+import json
+import logging
+import os
+import signal
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Callable
+
+# upper bounds (in seconds) of the histogram buckets, anything slower lands in the last (overflow) bucket
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+# phases of a transfer, each one measured from the end of the previous phase
+TRANSFER_PHASES = ("parse", "file_ready", "first_block", "transfer")
+
+@dataclass(slots=True)
+class TransferTrace:
+    """
+    Phase timestamps of a single transfer, taken with time.monotonic() so recording them is cheap.
+    requested_at -> parsed_at -> file_ready_at -> first_block_at -> last_ack_at
+    """
+    client: tuple
+    requested_at: float = field(default_factory=time.monotonic)
+    filename: str = None
+    parsed_at: float = None
+    file_ready_at: float = None
+    first_block_at: float = None
+    last_ack_at: float = None
+    blocks_sent: int = 0
+    retransmits: int = 0
+
+    def mark_parsed(self, filename: str) -> None:
+        self.filename = filename
+        self.parsed_at = time.monotonic()
+
+    def mark_file_ready(self) -> None:
+        self.file_ready_at = time.monotonic()
+
+    def mark_block_sent(self) -> None:
+        if self.first_block_at is None:
+            self.first_block_at = time.monotonic()
+        self.blocks_sent += 1
+
+    def mark_retransmit(self) -> None:
+        self.retransmits += 1
+
+    def mark_complete(self) -> None:
+        self.last_ack_at = time.monotonic()
+
+    def durations(self) -> dict:
+        """
+        Duration of every phase that was reached, in seconds.
+        """
+        marks = (self.requested_at, self.parsed_at, self.file_ready_at, self.first_block_at, self.last_ack_at)
+        result = {}
+        for phase, start, end in zip(TRANSFER_PHASES, marks, marks[1:]):
+            if start is None or end is None:
+                break
+            result[phase] = end - start
+        return result
+
+class Histogram:
+    """
+    Fixed bucket latency histogram, see HISTOGRAM_BUCKETS for the bucket bounds.
+    """
+    def __init__(self, buckets: tuple = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> dict:
+        labels = [f"<={bound}s" for bound in self.buckets] + [f">{self.buckets[-1]}s"]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+class TransferStats:
+    """
+    Aggregates finished transfer traces into per phase histograms and optionally appends every trace
+    to a JSON lines trace log, which is opened once and line buffered so recording a trace does not reopen it.
+    """
+    def __init__(self, trace_log: str = None, logger: logging.Logger = None):
+        self.logger = logger
+        self.trace_log = trace_log
+        self._trace_file = None
+        if trace_log is not None:
+            try:
+                self._trace_file = open(trace_log, "a", buffering=1)
+            except OSError as e:
+                self.logger.error(f"Failed to open transfer trace log {trace_log}: {e}")
+        self.histograms = {phase: Histogram() for phase in TRANSFER_PHASES}
+        self.completed = 0
+        self.failed = 0
+        self.retransmits = 0
+
+    def record(self, trace: TransferTrace, completed: bool = True) -> None:
+        """
+        Record a finished (or abandoned) transfer.
+        """
+        durations = trace.durations()
+        for phase, duration in durations.items():
+            self.histograms[phase].observe(duration)
+        if completed:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.retransmits += trace.retransmits
+        if self._trace_file is not None:
+            self._write_trace(trace, durations, completed)
+
+    def _write_trace(self, trace: TransferTrace, durations: dict, completed: bool) -> None:
+        entry = {
+            "client": f"{trace.client[0]}:{trace.client[1]}",
+            "filename": trace.filename,
+            "completed": completed,
+            "blocks_sent": trace.blocks_sent,
+            "retransmits": trace.retransmits,
+            **durations,
+        }
+        try:
+            self._trace_file.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            self.logger.error(f"Failed to write transfer trace to {self.trace_log}: {e}")
+
+    def snapshot(self) -> dict:
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "retransmits": self.retransmits,
+            "phases": {phase: histogram.snapshot() for phase, histogram in self.histograms.items()},
+        }
+
+    def report(self) -> None:
+        """
+        Log the current histograms.
+        """
+        self.logger.info(f"Transfer stats: {json.dumps(self.snapshot())}")
+
+    def close(self) -> None:
+        """
+        Close the trace log, called when the server stops.
+        """
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+class Profiler:
+    """
+    On demand profiling of the running server, driven by signals so production traffic can be profiled
+    without a restart:
+    - SIGUSR1 starts a cProfile capture, sending it again stops it and writes the stats to the output directory.
+    - SIGUSR2 starts tracemalloc, sending it again writes a snapshot and logs the top allocations.
+    """
+    def __init__(self, output_dir: str, report: Callable[[], None] = None, logger: logging.Logger = None):
+        self.output_dir = output_dir
+        self.report = report  # called when a cProfile capture is written, to log the server stats alongside it
+        self.logger = logger
+        self._profile: cProfile.Profile | None = None
+        self._captures = 0  # number of captures written, so captures taken within the same second do not overwrite each other
+
+    def install(self, loop: asyncio.AbstractEventLoop) -> None:
+        if not hasattr(signal, "SIGUSR1"):
+            self.logger.warning("Profiling signals are not supported on this platform")
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        loop.add_signal_handler(signal.SIGUSR1, self.toggle_cprofile)
+        loop.add_signal_handler(signal.SIGUSR2, self.toggle_tracemalloc)
+        self.logger.info(f"Profiling enabled (pid {os.getpid()}): SIGUSR1 toggles cProfile, SIGUSR2 toggles tracemalloc, output in {self.output_dir}")
+
+    def _output_path(self, kind: str) -> str:
+        self._captures += 1
+        return os.path.join(self.output_dir, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self._captures}.{kind}")
+
+    def toggle_cprofile(self) -> None:
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            self.logger.info("cProfile capture started")
+            return
+        self._profile.disable()
+        path = self._output_path("pstats")
+        self._profile.dump_stats(path)
+        self._profile = None
+        self.logger.info(f"cProfile capture written to {path}")
+        if self.report is not None:
+            self.report()
+
+    def toggle_tracemalloc(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.logger.info("tracemalloc capture started")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        path = self._output_path("tracemalloc")
+        snapshot.dump(path)
+        top = "\n".join(str(stat) for stat in snapshot.statistics("lineno")[:10])
+        self.logger.info(f"tracemalloc snapshot written to {path}, top allocations:\n{top}")
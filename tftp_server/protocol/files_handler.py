@@ -1,38 +1,156 @@
 import asyncio
+import hashlib
 import os
-from async_lru import alru_cache
+from collections import OrderedDict
 import aiofiles
 from enum import Enum
 
+STREAM_THRESHOLD = 32 * 1024 * 1024  # files of at least this size are streamed from disk instead of read into memory
+
 class FileType(Enum):
     online = 1  # File is available online
     on_disk = 2  # File is stored on disk
 
-async def get_file_from_disk(file_path: str) -> bytes|None:
+class FileStream:
+    """
+    Read only view of a large file, slicing it reads the block at that offset with os.pread instead of holding the file in memory.
+    The file descriptor stays open as long as a session serving the file (or the content store) references the stream.
+    A file rewritten in place while it is served yields its new bytes, or short blocks if it was truncated, instead of
+    the SIGBUS a memory mapping would raise.
+    """
+    __slots__ = ("fd", "size")
+
+    def __init__(self, file_path: str):
+        self.fd = os.open(file_path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: slice) -> bytes:
+        return os.pread(self.fd, index.stop - index.start, index.start)
+
+    def __del__(self):
+        if getattr(self, "fd", None) is not None:
+            os.close(self.fd)
+
+async def get_file_from_disk(file_path: str) -> bytes|FileStream|None:
     """
     Fetch a file from the disk.
     :param file_path: Path to the file on disk.
-    :return: File content as bytes, if path does not exist or is not a file or permission errors, return None.
+    :return: File content as bytes, or a FileStream for files of at least STREAM_THRESHOLD bytes so multi-gigabyte
+    images are read block by block. If path does not exist or is not a file or permission errors, return None.
     """
     if not (os.path.exists(file_path) and os.path.isfile(file_path) and os.access(file_path, os.R_OK)):
         return None 
+    if os.path.getsize(file_path) >= STREAM_THRESHOLD:
+        return FileStream(file_path)
     async with aiofiles.open(file_path, 'rb') as f:
         return await f.read()    
 
-@alru_cache(maxsize=128)
-async def get_file(file_type: FileType, file_path: str) -> bytes|None:
-    if file_type == FileType.on_disk:
-        return await get_file_from_disk(file_path)
-    elif file_type == FileType.online:
-        # Placeholder for online file fetching logic
-        # This could be an HTTP request or any other method to fetch the file online
-        pass
+class ContentStore:
+    """
+    In memory store of file contents keyed by identity instead of path, so the many names of the same image
+    (symlinks, copies, per-device names) and all the sessions serving it share a single buffer.
+    A path resolves with a stat to its identity (device, inode, size, mtime), so every link to a file shares its
+    buffer right away. Copies have their own inode: a loaded content is only hashed when a stored content has the same
+    size, and shares the stored buffer if their sha256 match. Large files are not held in memory and are only shared by identity.
+    """
+    def __init__(self, max_contents: int = 128):
+        self.max_contents = max_contents
+        self._contents: OrderedDict[tuple, bytes|FileStream] = OrderedDict()  # identity -> content in LRU order, identical contents share one buffer
+        self._digests: dict[tuple, str] = {}  # identity -> sha256, only computed for contents sharing their size with another
+        self._paths: dict[str, tuple] = {}  # path -> identity, the aliases of every content
+        self._loading: dict[tuple, asyncio.Task] = {}  # identity -> pending load, so concurrent requests load a file once
+
+    async def get(self, file_path: str) -> bytes|FileStream|None:
+        """
+        Fetch the content of a file, loading it from disk only if its identity is not stored yet.
+        :return: Shared content of the file, None if the path does not exist or is not a readable file.
+        """
+        try:
+            # follows symlinks, so links share the identity of their target
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        content = self._contents.get(identity)
+        if content is None:
+            if identity not in self._loading:
+                self._loading[identity] = asyncio.create_task(self._load(file_path, identity))
+            content = await asyncio.shield(self._loading[identity])
+            if content is None:
+                return None
+        else:
+            self._contents.move_to_end(identity)
+        if identity in self._contents:
+            self._paths[file_path] = identity
+        return content
+
+    async def _load(self, file_path: str, identity: tuple) -> bytes|FileStream|None:
+        try:
+            content = await get_file_from_disk(file_path)
+            if isinstance(content, bytes):
+                content = await self._deduplicate(identity, content)
+        finally:
+            del self._loading[identity]
+        if content is None:
+            return None
+        # the file changed since an older version was stored, that version is not served anymore
+        for stale in [other for other in self._contents if other[:2] == identity[:2]]:
+            self._drop(stale)
+        self._contents[identity] = content
+        while len(self._contents) > self.max_contents:
+            self._drop(next(iter(self._contents)))
+        return content
+
+    async def _deduplicate(self, identity: tuple, content: bytes) -> bytes:
+        """
+        Return the stored buffer holding the same bytes as content if there is one, content otherwise.
+        """
+        same_size = [(other, stored) for other, stored in self._contents.items()
+                     if isinstance(stored, bytes) and len(stored) == len(content)]
+        if not same_size:
+            return content
+        digest = self._digests[identity] = await self._hash(content)
+        for other, stored in same_size:
+            other_digest = self._digests.get(other) or await self._hash(stored)
+            if other in self._contents:
+                self._digests[other] = other_digest
+            if other_digest == digest:
+                return stored
+        return content
+
+    @staticmethod
+    async def _hash(content: bytes) -> str:
+        return await asyncio.to_thread(lambda: hashlib.sha256(content).hexdigest())
+
+    def _drop(self, identity: tuple) -> None:
+        del self._contents[identity]
+        self._digests.pop(identity, None)
+        self._paths = {path: i for path, i in self._paths.items() if i != identity}
+
+    def snapshot(self) -> dict:
+        """
+        Deduplication report, bytes_deduplicated is the memory a path keyed cache would have used on top of bytes_stored.
+        Contents that are not held in memory (large files) are not counted in the byte figures.
+        """
+        buffers = {id(content): len(content) for content in self._contents.values() if isinstance(content, bytes)}
+        path_contents = [self._contents[identity] for identity in self._paths.values()]
+        referenced = {id(content): len(content) for content in path_contents if isinstance(content, bytes)}
+        return {
+            "identities": len(self._contents),
+            "paths": len(self._paths),
+            "buffers": len(buffers),
+            "bytes_stored": sum(buffers.values()),
+            "bytes_deduplicated": sum(len(content) for content in path_contents if isinstance(content, bytes)) - sum(referenced.values()),
+        }
+
+content_store = ContentStore()
 
-@alru_cache(maxsize=128)
-async def get_file_single_mode(ip: str, port: str, file_type: FileType, file_path: str) -> bytes|None:
+async def get_file(file_type: FileType, file_path: str) -> bytes|FileStream|None:
     if file_type == FileType.on_disk:
-        result = await get_file_from_disk(file_path)
-        return (ip, port), result
+        return await content_store.get(file_path)
     elif file_type == FileType.online:
         # Placeholder for online file fetching logic
         # This could be an HTTP request or any other method to fetch the file online
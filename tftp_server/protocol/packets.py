@@ -1,5 +1,5 @@
 import struct
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Optional
 
@@ -9,6 +9,7 @@ class Opcode(Enum):
     DATA = 3  # Data Packet
     ACK = 4  # Acknowledgment
     ERROR = 5  # Error Packet
+    OACK = 6  # Option Acknowledgment (RFC 2347)
 
 class ErrorCode(Enum):
     NOT_FOUND = 1  # File not found
@@ -33,19 +34,19 @@ class RrqPacket(TftpPacket):
           -----------------------------------------------
    RRQ/  | 01/02 |  Filename  |   0  |    Mode    |   0  |
    WRQ    -----------------------------------------------
+    Options (RFC 2347) follow the mode as additional null terminated name/value pairs.
     """
     filename: str
     mode: str
+    options: dict = field(default_factory=dict)
     
     def __post_init__(self):
         self.opcode = Opcode.RRQ
 
     @property
     def get_bytes(self):
-        return struct.pack(f"!H {len(self.filename)}s {len(self.mode)}s", 
-                           self.opcode.value, 
-                           (self.filename + '\0').encode(), 
-                           (self.mode + '\0').encode())
+        return struct.pack("!H", self.opcode.value) + _pack_strings(
+            self.filename, self.mode, *(item for option in self.options.items() for item in option))
     
 @dataclass
 class WrqPacket(TftpPacket):
@@ -135,6 +136,38 @@ class ErrorPacket(TftpPacket):
                            self.error_code.value, 
                            (self.error_message + '\0').encode())
 
+@dataclass
+class OackPacket(TftpPacket):
+    """
+    Option Acknowledgment Packet (RFC 2347)
+      +-------+---~~---+---+---~~---+---+---~~---+---+---~~---+---+
+      |  opc  |  opt1  | 0 | value1 | 0 |  optN  | 0 | valueN | 0 |
+      +-------+---~~---+---+---~~---+---+---~~---+---+---~~---+---+
+    """
+    options: dict
+
+    def __post_init__(self):
+        self.opcode = Opcode.OACK
+
+    @property
+    def get_bytes(self):
+        return struct.pack("!H", self.opcode.value) + _pack_strings(
+            *(item for option in self.options.items() for item in option))
+
+def _pack_strings(*strings: str) -> bytes:
+    """
+    Pack strings as consecutive null terminated fields.
+    """
+    return b"".join(string.encode() + b"\0" for string in strings)
+
+def _parse_options(fields: list) -> dict:
+    """
+    Parse the name/value pairs following the mode of a request, option names are case insensitive.
+    Undecodable bytes are replaced rather than failing the request, such an option is then not negotiated.
+    """
+    return {name.decode(errors="replace").lower(): value.decode(errors="replace")
+            for name, value in zip(fields[::2], fields[1::2]) if name}
+
 def parse_packet(data: bytes) -> TftpPacket:
     """
     Parse a TFTP packet from bytes.
@@ -143,8 +176,8 @@ def parse_packet(data: bytes) -> TftpPacket:
         opcode = struct.unpack("!H", data[:2])[0]
         
         if opcode == Opcode.RRQ.value:
-            filename, mode = data[2:].split(b'\0')[:2]
-            return RrqPacket(filename=filename.decode(), mode=mode.decode())
+            filename, mode, *options = data[2:].split(b'\0')
+            return RrqPacket(filename=filename.decode(), mode=mode.decode(), options=_parse_options(options))
         
         elif opcode == Opcode.WRQ.value:
             filename, mode = data[2:].split(b'\0')[:2]
@@ -162,5 +195,6 @@ def parse_packet(data: bytes) -> TftpPacket:
             error_code, = struct.unpack("!H", data[2:4])
             error_message = data[4:-1].decode()  # Exclude the null terminator
             return ErrorPacket(error_code=ErrorCode(error_code), error_message=error_message)
-    except struct.error as e:
+    except (struct.error, ValueError) as e:
+        # ValueError covers missing fields, undecodable strings (UnicodeDecodeError) and unknown error codes
         return None        
@@ -1,13 +1,36 @@
 import asyncio
+import functools
 import logging
+import sys
+import time
 from tftp_server.protocol import packets
 from enum import Enum
-from dataclasses import dataclass
-from tftp_server.protocol.files_handler import get_file, FileType, get_file_single_mode
-from expiring_dict import ExpiringDict
+from dataclasses import dataclass, field
+from tftp_server.protocol.files_handler import get_file, FileType
+from tftp_server.diagnostics import TransferStats, TransferTrace
 MAX_BLOCK_VALUE = 65535
+ROLLOVER_OPTION = "rollover"
 
-@dataclass
+def wire_block(offset: int, block_size: int, rollover: int = 0) -> int:
+    """
+    Map the byte offset of a data block to the 16 bit block number sent on the wire.
+    Blocks are numbered from 1, after block 65535 the numbering wraps around to the rollover value (0 or 1).
+    """
+    block = offset // block_size + 1
+    if block <= MAX_BLOCK_VALUE:
+        return block
+    return rollover + (block - MAX_BLOCK_VALUE - 1) % (MAX_BLOCK_VALUE + 1 - rollover)
+
+def negotiate_options(requested: dict) -> dict:
+    """
+    Select the requested options (RFC 2347) the server supports, unsupported or invalid options are ignored.
+    """
+    accepted = {}
+    if requested.get(ROLLOVER_OPTION) in ("0", "1"):
+        accepted[ROLLOVER_OPTION] = requested[ROLLOVER_OPTION]
+    return accepted
+
+@dataclass(slots=True)
 class TftpCounters:
     """
     Class to hold counters for the TFTP server i.e. number of retrie and any other counters that might be needed.
@@ -20,29 +43,50 @@ class TftpCounters:
         """
         self.retries = 0
 
-@dataclass
+@dataclass(slots=True)
 class StateConfig:
     """
     Base Configuration for ephemeral connections states
     """
     filename: str
     mode: str
-    block: int = 1
 
     def __post_init__(self):
         if not isinstance(self.filename, str) or not self.filename:
             raise ValueError("Filename must be a non-empty string.")
         if not isinstance(self.mode, str) or self.mode not in ["octet", "netascii"]:
             raise ValueError("Mode must be either 'octet' or 'netascii'.")
+        self.mode = sys.intern(self.mode)  # share the mode string between sessions
 
-@dataclass
+@dataclass(slots=True)
 class RrqConfig(StateConfig):
     """
     Configuration for the RRQ state.
     """
-    file_data: str = None  # filedata to send to the client (will be loading everything in memory)
+    file_data: bytes = None  # filedata to send to the client, large files are a FileStream instead of loaded in memory
     file_size: int = None
-    block_overflows: int = 0  # number of times the block overflows in the protocol, as it is only 16 bits
+    offset: int = 0  # byte offset of the block awaiting an ACK, only mapped to a 16 bit block number on the wire
+    options: dict = None  # options acknowledged to the client, see negotiate_options, None if there are none
+    oack_pending: bool = False  # an OACK was sent and the server waits for the ACK of block 0
+
+    def __post_init__(self):
+        # zero argument super() does not work in slots dataclasses
+        StateConfig.__post_init__(self)
+        # most requests carry no options, do not keep an empty dict per session
+        self.options = negotiate_options(self.options or {}) or None
+
+    @property
+    def rollover(self) -> int:
+        return int(self.options.get(ROLLOVER_OPTION, 0)) if self.options else 0
+
+    def wire_block(self, block_size: int) -> int:
+        return wire_block(self.offset, block_size, self.rollover)
+
+    def read_block(self, block_size: int) -> bytes:
+        """
+        Data of the block at the current offset, empty past the end of the file to terminate the transfer.
+        """
+        return self.file_data[self.offset:self.offset + block_size]
 
 class ServerStates(Enum):
     """
@@ -55,12 +99,14 @@ class ServerStates(Enum):
     # state to indicate that the client should be killed
     KILL = 4
 
-@dataclass
+@dataclass(slots=True)
 class SinglePortClient():
     ip: str  # Client IP address
     port: int # Client port number
     state_config: StateConfig = None # Configuration for the current state
     state: ServerStates = ServerStates.INITIAL
+    trace: TransferTrace = None # Phase timings of the current transfer
+    last_seen: float = field(default_factory=time.monotonic) # time.monotonic() of the last packet received from the client
 
 
 class TftpServerProtocol(asyncio.DatagramProtocol):
@@ -68,25 +114,46 @@ class TftpServerProtocol(asyncio.DatagramProtocol):
         self.server = server
         self.logger = logger
         self.transport = None
-        self.client_dict = ExpiringDict(max_len = 1000)  # Dictionary to hold client addresses and their corresponding ephemeral port protocols for single port mode
+        self.client_dict: dict = {}  # Dictionary to hold client addresses and their corresponding clients for single port mode
         self.base_file_dir: str = self.server.config.file_directory
+        # a silent client is expired once it stopped retrying, i.e. after as long as an ephemeral port session waits for it
+        self.client_ttl: int = self.server.config.timeout * (self.server.config.retries + 1)
+        self._expiry_handle: asyncio.TimerHandle | None = None
 
     def connection_made(self, transport) -> None:
         self.transport = transport
         self.logger.info(f"TFTP socket initialized and listening on {self.server.config.host}:{self.server.config.port}")
+        if self.server.config.single_port:
+            self._schedule_client_expiry()
+
+    def connection_lost(self, exc):
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+            self._expiry_handle = None
+        return super().connection_lost(exc)
+
+    def _schedule_client_expiry(self) -> None:
+        self._expiry_handle = asyncio.get_running_loop().call_later(self.server.config.timeout, self._expire_clients)
+
+    def _expire_clients(self) -> None:
+        """
+        Drop the single port clients that have been silent for longer than client_ttl, their transfers are recorded as failed.
+        """
+        deadline = time.monotonic() - self.client_ttl
+        for addr in [addr for addr, client in self.client_dict.items() if client.last_seen < deadline]:
+            client = self.client_dict.pop(addr)
+            self.logger.warning(f"Client {addr} silent for more than {self.client_ttl}s in state {client.state}, dropping it")
+            self._record_trace(client, completed=False)
+        self._schedule_client_expiry()
 
     def datagram_received(self, data: bytes, addr) -> None:
         self.logger.info(f"Received data from {addr}: {data}")
         try:
             if not self.server.config.single_port:
+                trace = TransferTrace(addr)
                 asyncio.create_task(
                     asyncio.get_running_loop().create_datagram_endpoint(
-                        lambda: TftpEphemeralPortProtocol(base_file_dir=self.server.config.file_directory, 
-                                                        client_ip=addr[0], client_port=addr[1], 
-                                                        initial_data=data, logger=self.logger,
-                                                        file_block_size=self.server.config.max_block_size
-                                                        , timeout=self.server.config.timeout,
-                                                        retries=self.server.config.retries),
+                        lambda: self.new_ephemeral_session(data, addr, trace),
                         local_addr=(self.server.config.host, 0) # binds to an ephemeral port
                     )
                 )
@@ -94,14 +161,28 @@ class TftpServerProtocol(asyncio.DatagramProtocol):
                 self.logger.info(f"Single port mode enabled, using existing port to serve {addr}")
                 if addr not in self.client_dict:
                     #this is a new client, start a new connection
-                    self.client_dict[addr] = SinglePortClient(addr[0], addr[1])
+                    self.client_dict[addr] = SinglePortClient(addr[0], addr[1], trace=TransferTrace(addr))
                     self.handle_new_connection(self.client_dict[addr], data)
                 else:
+                    self.client_dict[addr].last_seen = time.monotonic()
                     self.handle_existing_connection(self.client_dict[addr], data, addr)
         except Exception as e:
             self.logger.error(f"Error in main protocol: {e}")
             return
     
+    def new_ephemeral_session(self, data: bytes, addr, trace: TransferTrace = None) -> "TftpEphemeralPortProtocol":
+        """
+        Create the protocol serving a client on its own ephemeral port, the transfer starts once its socket is bound.
+        """
+        return TftpEphemeralPortProtocol(base_file_dir=self.server.config.file_directory, 
+                                         client_ip=addr[0], client_port=addr[1], 
+                                         initial_data=data, logger=self.logger,
+                                         file_block_size=self.server.config.max_block_size,
+                                         timeout=self.server.config.timeout,
+                                         retries=self.server.config.retries,
+                                         stats=self.server.stats,
+                                         trace=trace if trace is not None else TransferTrace(addr))
+
     def handle_new_connection(self, client: SinglePortClient, data) -> None:
         initial_packet = packets.parse_packet(data)
         if initial_packet is None:
@@ -111,13 +192,14 @@ class TftpServerProtocol(asyncio.DatagramProtocol):
         if initial_packet.opcode == packets.Opcode.RRQ:
             self.logger.info(f"Received RRQ from {client.ip}:{client.port} for file: {initial_packet.filename}")
             client.state = ServerStates.RRQ
+            client.trace.mark_parsed(initial_packet.filename)
             try:
-                client.state_config = RrqConfig(filename=initial_packet.filename, mode=initial_packet.mode)
+                client.state_config = RrqConfig(filename=initial_packet.filename, mode=initial_packet.mode, options=initial_packet.options)
                 #get the file data
                 get_file_task = asyncio.create_task(
-                    get_file_single_mode(client.ip,client.port, FileType.on_disk, f"{self.base_file_dir}/{client.state_config.filename}")
+                    get_file(FileType.on_disk, f"{self.base_file_dir}/{client.state_config.filename}")
                 )
-                get_file_task.add_done_callback(self._handle_get_file_task_result)
+                get_file_task.add_done_callback(functools.partial(self._handle_get_file_task_result, (client.ip, client.port)))
             except ValueError as e:
                 self.send_error(client, packets.ErrorCode.ILLEGAL_OPERATION, str(e))
                 return
@@ -143,6 +225,8 @@ class TftpServerProtocol(asyncio.DatagramProtocol):
             if packet.opcode == packets.Opcode.ACK:
                 self.logger.info(f"Handling RRQ continuation for {client.state_config.filename} in mode {client.state_config.mode}")
                 self.handle_rrq_connection(client, packet, addr)
+            elif self._is_repeated_rrq(client, packet):
+                self.handle_repeated_rrq(client, addr)
             else:
                 self.logger.error(f"Received unexpected opcode {packet.opcode} in RRQ state from {addr}")
                 self.send_error(client, packets.ErrorCode.ILLEGAL_OPERATION, "Unexpected opcode in RRQ state")
@@ -150,8 +234,7 @@ class TftpServerProtocol(asyncio.DatagramProtocol):
             self.logger.info(f"Received WRQ continuation from {addr}, but write requests are not supported yet")
             self.send_error(client, packets.ErrorCode.ILLEGAL_OPERATION, "Write requests are not supported yet")
         elif client.state == ServerStates.KILL:
-            self.logger.info(f"Single port feature is complete, killing connection with {addr}")
-            del self.client_dict[addr]
+            self.handle_final_ack(client, packets.parse_packet(data), addr)
         else:
             self.logger.error(f"Received data in unexpected state {client.state} from {addr}")
             self.send_error(client, packets.ErrorCode.ILLEGAL_OPERATION, "Unexpected state for received data")
@@ -160,66 +243,137 @@ class TftpServerProtocol(asyncio.DatagramProtocol):
         """
         Handle RRQ continuation, when the server starts to request for more data packets.
         """
-        if packet.block == (client.state_config.block - 1) % (MAX_BLOCK_VALUE + 1):
-            self.send_data_block(client)    
+        config = client.state_config
+        expected_block = 0 if config.oack_pending else config.wire_block(self.server.config.max_block_size)
+        if packet.block != expected_block:
+            self.logger.warning(f"Received ACK for block {packet.block} but expected block {expected_block}")
+            return
+        if config.oack_pending:
+            config.oack_pending = False
         else:
-            self.logger.warning(f"Received ACK for block {packet.block} but expected block {(client.state_config.block - 1) % (MAX_BLOCK_VALUE + 1)}")
+            config.offset += self.server.config.max_block_size
+        self.send_data_block(client)
 
-    def _handle_get_file_task_result(self, future: asyncio.Future) -> None:
+    @staticmethod
+    def _is_repeated_rrq(client: SinglePortClient, packet: packets.TftpPacket) -> bool:
+        """
+        Whether the packet is the request being served sent again, before block 1 was acknowledged.
+        """
+        return (packet.opcode == packets.Opcode.RRQ and packet.filename == client.state_config.filename
+                and client.state_config.offset == 0)
+
+    def handle_repeated_rrq(self, client: SinglePortClient, addr) -> None:
+        """
+        There is no retransmit timer in single port mode, a client whose OACK or first block was lost sends its RRQ
+        again: answer it with the OACK or the first block again.
+        """
+        config = client.state_config
+        if config.file_data is None:
+            self.logger.info(f"Repeated RRQ from {addr} while {config.filename} is loading, ignoring it")
+            return
+        self.logger.warning(f"Repeated RRQ from {addr}, resending the {'OACK' if config.oack_pending else 'first block'}")
+        client.trace.mark_retransmit()
+        if config.oack_pending:
+            self.send_oack(client)
+        else:
+            self.send_data_block(client)
+
+    def handle_final_ack(self, client: SinglePortClient, packet: packets.TftpPacket, addr) -> None:
+        """
+        The final block was sent, the transfer is complete once the client acknowledges that block.
+        There is no retransmit timer in single port mode, so an ACK for any other block means the final block was lost
+        and it is sent again.
+        """
+        final_block = client.state_config.wire_block(self.server.config.max_block_size)
+        if packet is not None and self._is_repeated_rrq(client, packet):
+            # the file fits in one block and that block was lost
+            self.handle_repeated_rrq(client, addr)
+            return
+        if packet is None or packet.opcode != packets.Opcode.ACK:
+            self.logger.warning(f"Ignoring unexpected packet from {addr} while waiting for the ACK of the final block {final_block}")
+            return
+        if packet.block != final_block:
+            self.logger.warning(f"Received ACK for block {packet.block} but expected the final block {final_block}, resending it")
+            client.trace.mark_retransmit()
+            self.send_data_block(client)
+            return
+        self.logger.info(f"Single port feature is complete, killing connection with {addr}")
+        client.trace.mark_complete()
+        self._record_trace(client, completed=True)
+        del self.client_dict[addr]
+
+    def _handle_get_file_task_result(self, addr, future: asyncio.Future) -> None:
         """
         Handles the first time the client makes a request to the server and the file is fetched.
         """
-        addr, file_data = future.result()
-        client = self.client_dict[addr]
+        file_data = future.result()
+        client = self.client_dict.get(addr)
+        if client is None:
+            # expired while the file was loading, its transfer was already recorded as failed
+            self.logger.warning(f"Client {addr} expired while its file was loading, dropping it")
+            return
         if file_data is None:
             self.logger.error(f"File {client.state_config.filename} not found or inaccessible")
-            self.send_error(packets.ErrorCode.NOT_FOUND, f"File {client.state_config.filename} not found")
+            self.send_error(client, packets.ErrorCode.NOT_FOUND, f"File {client.state_config.filename} not found")
             return
         client.state_config.file_data = file_data
         client.state_config.file_size = len(file_data)
+        client.trace.mark_file_ready()
         self.logger.info(f"File {client.state_config.filename} loaded successfully, sending data to client")
-        self.send_data_block(client)
-        # Send the first block of data
+        if client.state_config.options:
+            # the client waits for the options to be acknowledged before the first block of data
+            self.send_oack(client)
+        else:
+            self.send_data_block(client)
 
     def send_data_block(self, client: SinglePortClient):
         """
-        Send a block of data to the client.
-        precondition: self.state_config.file_data is not None, self.state is ServerStates.RRQ and self.state_config.block is a valid block number.
-        """
-        start = (client.state_config.block - 1) * self.server.config.max_block_size
-        if client.state_config.block_overflows > 0:
-            # the first time he protocol starts the block starts with 1 but when it overflows, it should start with 0
-            # although the protocol is not meant to be used with files of this size since the protocol is stop and wait
-            # to account for the overflows > 1 
-            start = (client.state_config.block_overflows - 1) * self.server.config.max_block_size * (MAX_BLOCK_VALUE + 1)
-            # to account for the first overflow since the index starts at 1 for the first block
-            start += self.server.config.max_block_size * MAX_BLOCK_VALUE
-            start += client.state_config.block * self.server.config.max_block_size
-        end = start + self.server.config.max_block_size
-        if start < client.state_config.file_size:
-            data_block = client.state_config.file_data[start:min(end, client.state_config.file_size)]
-        else:
-            data_block = "".encode()  # No more data to send, send an empty block to kill the connection
-        data_packet = packets.DataPacket(block=client.state_config.block, data=data_block)
+        Send the block at the current offset to the client.
+        precondition: client.state_config.file_data is not None and client.state is ServerStates.RRQ.
+        """
+        config = client.state_config
+        block_size = self.server.config.max_block_size
+        data_block = config.read_block(block_size)
+        block = config.wire_block(block_size)
+        data_packet = packets.DataPacket(block=block, data=data_block)
         self.transport.sendto(data_packet.get_bytes, (client.ip, client.port))
-        self.logger.info(f"Sent block {client.state_config.block} to {client.ip}:{client.port}")        
-        # Increment the block number for the next packet
-        if client.state_config.block >= MAX_BLOCK_VALUE:
-            client.state_config.block_overflows += 1
-        client.state_config.block = (client.state_config.block + 1) % (MAX_BLOCK_VALUE + 1)
-        if end > client.state_config.file_size: client.state = ServerStates.KILL
+        client.trace.mark_block_sent()
+        self.logger.info(f"Sent block {block} to {client.ip}:{client.port}")        
+        if len(data_block) < block_size: client.state = ServerStates.KILL
 
+    def send_oack(self, client: SinglePortClient) -> None:
+        """
+        Acknowledge the negotiated options, the client answers with an ACK for block 0.
+        """
+        client.state_config.oack_pending = True
+        oack_packet = packets.OackPacket(options=client.state_config.options)
+        self.transport.sendto(oack_packet.get_bytes, (client.ip, client.port))
+        self.logger.info(f"Sent OACK {client.state_config.options} to {client.ip}:{client.port}")
 
     def send_error(self, client: SinglePortClient, error_code: packets.ErrorCode, error_message: str) -> None:
         client.state = ServerStates.ERROR
         error_packet = packets.ErrorPacket(error_code, error_message)
         self.transport.sendto(error_packet.get_bytes, (client.ip, client.port))
         self.logger.error(f"Sent error packet to {client.ip}:{client.port} with code {error_code} and message '{error_message}'")
+        self._record_trace(client, completed=False)
+
+    def _record_trace(self, client: SinglePortClient, completed: bool) -> None:
+        """
+        Hand the transfer trace of the client over to the server stats, a trace is only ever recorded once.
+        """
+        if client.trace is not None:
+            self.server.stats.record(client.trace, completed=completed)
+            client.trace = None
         
 
 class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
+    # one instance per transfer, slots keep the per session footprint small
+    __slots__ = ("logger", "base_file_dir", "client_ip", "client_port", "initial_data", "transport", "state",
+                 "state_config", "block_size", "timeout", "max_retries", "_counters", "_timeout_handle", "stats", "trace")
+
     def __init__(self, file_block_size: int, base_file_dir: str, client_ip: str
-                 , client_port: int, initial_data:bytes, timeout:int, retries:int, logger: logging.Logger = None):
+                 , client_port: int, initial_data:bytes, timeout:int, retries:int, logger: logging.Logger = None,
+                 stats: TransferStats = None, trace: TransferTrace = None):
         self.logger = logger
         self.base_file_dir: str = base_file_dir 
         self.client_ip:int = client_ip
@@ -233,6 +387,8 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
         self.max_retries: int = retries
         self._counters: TftpCounters = TftpCounters()  # Counters for the TFTP server
         self._timeout_handle: asyncio.Handle | None = None  # Handle for the timeout task 
+        self.stats: TransferStats | None = stats
+        self.trace: TransferTrace = trace if trace is not None else TransferTrace((client_ip, client_port))
 
     def connection_made(self, transport) -> None:
         self.transport = transport
@@ -247,6 +403,10 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
             # unknow packet type, close the connnection since client is not following the protocol
             self.transport.close()
             return
+        if self.state == ServerStates.KILL:
+            # only the ACK of the final block is progress, the retransmit timer keeps running until it arrives
+            self.handle_final_ack(packet, addr)
+            return
         # Handle the request and send a response
         self._reset_timeout()
         self._counters.reset()  # Reset the counters for each new packet received
@@ -256,9 +416,6 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
         elif self.state == ServerStates.WRQ and packet.opcode == packets.Opcode.DATA:
             self.logger.info(f"Handling WRQ continuation for {self.state_config.filename} in mode {self.state_config.mode}")
             self.send_error(packets.ErrorCode.ILLEGAL_OPERATION, "Write requests are not supported yet")
-        elif self.state == ServerStates.KILL:
-            self.logger.info(f"ephemeral port feature is complete, killing socket")
-            self.transport.close()
         else:
             self.logger.error(f"Received data in unexpected state {self.state} from {addr}")
             self.send_error(packets.ErrorCode.ILLEGAL_OPERATION, "Unexpected state for received data")
@@ -272,6 +429,7 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
 
     def handle_new_connection(self) -> None:
         initial_packet = packets.parse_packet(self.initial_data)
+        self.initial_data = None  # not needed once parsed, do not keep it for the whole transfer
         if initial_packet is None:
             self.logger.error("Failed to parse initial packet")
             self.transport.close()
@@ -279,8 +437,9 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
         if initial_packet.opcode == packets.Opcode.RRQ:
             self.logger.info(f"Received RRQ from {self.client_ip}:{self.client_port} for file: {initial_packet.filename}")
             self.state = ServerStates.RRQ
+            self.trace.mark_parsed(initial_packet.filename)
             try:
-                self.state_config = RrqConfig(filename=initial_packet.filename, mode=initial_packet.mode)
+                self.state_config = RrqConfig(filename=initial_packet.filename, mode=initial_packet.mode, options=initial_packet.options)
                 #get the file data
                 get_file_task = asyncio.create_task(
                     get_file(FileType.on_disk, f"{self.base_file_dir}/{self.state_config.filename}")
@@ -311,37 +470,37 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
             return
         self.state_config.file_data = file_data
         self.state_config.file_size = len(file_data)
+        self.trace.mark_file_ready()
         self.logger.info(f"File {self.state_config.filename} loaded successfully, sending data to client")
-        self.send_data_block()
-        # Send the first block of data
+        if self.state_config.options:
+            # the client waits for the options to be acknowledged before the first block of data
+            self.send_oack()
+        else:
+            self.send_data_block()
+        # resend the OACK or the first block if the client does not acknowledge it
+        self._reset_timeout()
 
     def send_data_block(self):
         """
-        Send a block of data to the client.
-        precondition: self.state_config.file_data is not None, self.state is ServerStates.RRQ and self.state_config.block is a valid block number.
-        """
-        start = (self.state_config.block - 1) * self.block_size
-        if self.state_config.block_overflows > 0:
-            # the first time he protocol starts the block starts with 1 but when it overflows, it should start with 0
-            # although the protocol is not meant to be used with files of this size since the protocol is stop and wait
-            # to account for the overflows > 1 
-            start = (self.state_config.block_overflows - 1) * self.block_size * (MAX_BLOCK_VALUE + 1)
-            # to account for the first overflow since the index starts at 1 for the first block
-            start += self.block_size * MAX_BLOCK_VALUE
-            start += self.state_config.block * self.block_size
-        end = start + self.block_size
-        if start < self.state_config.file_size:
-            data_block = self.state_config.file_data[start:min(end, self.state_config.file_size)]
-        else:
-            data_block = "".encode()  # No more data to send, send an empty block to kill the connection
-        data_packet = packets.DataPacket(block=self.state_config.block, data=data_block)
+        Send the block at the current offset to the client.
+        precondition: self.state_config.file_data is not None and self.state is ServerStates.RRQ.
+        """
+        data_block = self.state_config.read_block(self.block_size)
+        block = self.state_config.wire_block(self.block_size)
+        data_packet = packets.DataPacket(block=block, data=data_block)
         self.transport.sendto(data_packet.get_bytes, (self.client_ip, self.client_port))
-        self.logger.info(f"Sent block {self.state_config.block} to {self.client_ip}:{self.client_port}")        
-        # Increment the block number for the next packet
-        if self.state_config.block >= MAX_BLOCK_VALUE:
-            self.state_config.block_overflows += 1
-        self.state_config.block = (self.state_config.block + 1) % (MAX_BLOCK_VALUE + 1)
-        if end > self.state_config.file_size: self.state = ServerStates.KILL
+        self.trace.mark_block_sent()
+        self.logger.info(f"Sent block {block} to {self.client_ip}:{self.client_port}")        
+        if len(data_block) < self.block_size: self.state = ServerStates.KILL
+
+    def send_oack(self) -> None:
+        """
+        Acknowledge the negotiated options, the client answers with an ACK for block 0.
+        """
+        self.state_config.oack_pending = True
+        oack_packet = packets.OackPacket(options=self.state_config.options)
+        self.transport.sendto(oack_packet.get_bytes, (self.client_ip, self.client_port))
+        self.logger.info(f"Sent OACK {self.state_config.options} to {self.client_ip}:{self.client_port}")
 
     def handle_rrq_connection(self, packet: packets.AckPacket, addr) -> None:
         """
@@ -361,10 +520,31 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
             """
             self.send_error(packets.ErrorCode.UNKNOWN_TID, "Unexpected client address")
             return
-        if packet.block == (self.state_config.block - 1) % (MAX_BLOCK_VALUE + 1):
-            self.send_data_block()    
+        expected_block = 0 if self.state_config.oack_pending else self.state_config.wire_block(self.block_size)
+        if packet.block != expected_block:
+            self.logger.warning(f"Received ACK for block {packet.block} but expected block {expected_block}")
+            return
+        if self.state_config.oack_pending:
+            self.state_config.oack_pending = False
         else:
-            self.logger.warning(f"Received ACK for block {packet.block} but expected block {(self.state_config.block - 1) % (MAX_BLOCK_VALUE + 1)}")
+            self.state_config.offset += self.block_size
+        self.send_data_block()
+
+    def handle_final_ack(self, packet: packets.TftpPacket, addr) -> None:
+        """
+        The final block was sent, the transfer is complete once the client acknowledges that block.
+        Any other packet is ignored, the retransmit timer resends the final block.
+        """
+        if addr[0] != self.client_ip or addr[1] != self.client_port:
+            self.logger.warning(f"Ignoring packet from unexpected address {addr}, expected {self.client_ip}:{self.client_port}")
+            return
+        final_block = self.state_config.wire_block(self.block_size)
+        if packet.opcode != packets.Opcode.ACK or packet.block != final_block:
+            self.logger.warning(f"Ignoring {packet.opcode} from {addr} while waiting for the ACK of the final block {final_block}")
+            return
+        self.logger.info(f"ephemeral port feature is complete, killing socket")
+        self.trace.mark_complete()
+        self.transport.close()
 
     def _cancel_timeout(self):
         """
@@ -392,8 +572,9 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
             # do not need to send a packet becasue the conenction is assumed to be dead
             self.transport.close()
             return
-        self.logger.warning(f"Timeout reached for {self.client_ip}:{self.client_port}, resending block {self.state_config.block - 1}")
-        if self.state == ServerStates.RRQ:
+        self.logger.warning(f"Timeout reached for {self.client_ip}:{self.client_port}, resending block {self.state_config.wire_block(self.block_size)}")
+        if self.state in (ServerStates.RRQ, ServerStates.KILL):
+            # in KILL state the final block was sent but not acknowledged, it is resent from the unchanged offset
             self._handle_rrq_timeout()
         elif self.state == ServerStates.WRQ:
             self.send_error(packets.ErrorCode.ILLEGAL_OPERATION, "Write requests are not supported yet")
@@ -408,19 +589,19 @@ class TftpEphemeralPortProtocol(asyncio.DatagramProtocol):
     def _handle_rrq_timeout(self):
         """
         Handle the timeout event for RRQ state.
-        If the maximum number of retries is reached, close the connection.
-        Otherwise, resend the last data block.
+        Resend the OACK if it was not acknowledged yet, otherwise the block at the current offset.
         """
-        if self.state_config.block == 0 and self.state_config.block_overflows > 0:
-            self.state_config.block_overflows -= 1
-            self.state_config.block = MAX_BLOCK_VALUE
+        self.trace.mark_retransmit()
+        if self.state_config.oack_pending:
+            self.send_oack()
         else:
-            self.state_config.block -= 1
-        self.send_data_block()
+            self.send_data_block()
 
     def connection_lost(self, exc):
         self.logger.info(f"Closing connection with {self.client_ip}:{self.client_port}")
         self._cancel_timeout()
+        if self.stats is not None:
+            self.stats.record(self.trace, completed=self.trace.last_ack_at is not None)
         return super().connection_lost(exc)
         
 
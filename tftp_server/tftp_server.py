@@ -1,6 +1,9 @@
 import asyncio
 from tftp_server.config import TftpConfig
 import logging
+import signal
+from tftp_server.diagnostics import Profiler, TransferStats
+from tftp_server.protocol.files_handler import content_store
 from tftp_server.protocol.protocol import TftpServerProtocol
     
 class TftpServer():
@@ -9,14 +12,21 @@ class TftpServer():
         self.transport = None
         self.protocol = None
         self.logger = logger
+        self.stats = TransferStats(trace_log=config.trace_log, logger=logger)
     
     def listen(self) -> None:
         endpoint = (event_loop := asyncio.get_event_loop()).create_datagram_endpoint(
             lambda: TftpServerProtocol(self, logger=self.logger),
             local_addr=(self.config.host, self.config.port)
         )
+        if self.config.profile:
+            Profiler(self.config.profile_directory, report=self.report, logger=self.logger).install(event_loop)
         self.logger.info(f"TFTP server listening on {self.config.host}:{self.config.port}")
         event_loop.run_until_complete(endpoint)
+        if hasattr(signal, "SIGHUP"):
+            # SIGTERM (systemd, kill) stops the loop so the stats are still reported, SIGHUP reports them on demand
+            event_loop.add_signal_handler(signal.SIGTERM, event_loop.stop)
+            event_loop.add_signal_handler(signal.SIGHUP, self.report)
         event_loop.run_forever()
     
     
@@ -25,4 +35,15 @@ class TftpServer():
             self.listen()
         except KeyboardInterrupt:
             self.logger.info("TFTP server stopped by user")
-    
\ No newline at end of file
+        finally:
+            self.logger.info("TFTP server stopped")
+            self.report()
+            self.stats.close()
+
+    def report(self) -> None:
+        """
+        Log the transfer histograms and the deduplication savings of the content store.
+        """
+        self.stats.report()
+        self.logger.info(f"Content store: {content_store.snapshot()}")
+    